@@ -1,7 +1,17 @@
 import streamlit as st
-from llm_api import call_llm, call_llm_docs, classify_intent,handle_order_query
-from vector_store import process_document_deepseek
+from typing import Optional, List, Dict
+from llm_api import call_llm, call_llm_docs, classify_intent,handle_order_query, summarize_conversation
+from vector_store import (process_document_deepseek, compare_embedding_backends, EMBEDDING_MODELS, EMBEDDING_BACKENDS,
+                          DEFAULT_EMBEDDING_MODEL, DEFAULT_EMBEDDING_BACKEND)
+import os
 from function import check_order_status
+from chat_history import ChatHistory
+from conversation_memory import ConversationMemory
+from resilience import ResiliencePolicy, ServiceUnavailableError
+from rate_limiter import configure_rate_limiter, get_rate_limiter
+
+#Number of messages rendered in the chat window, and added by "show earlier messages"
+CHAT_PAGE_SIZE = 20
 
 # Custom CSS styles
 st.markdown("""
@@ -48,7 +58,11 @@ def init_session_state():
         st.session_state.llm_config ={
             'url':'https://api.deepseek.com',
             'api_key':'',
-            'model':'deepseek-chat'
+            'model':'deepseek-chat',
+            'fallback_url':'',
+            'timeout':60.0,
+            'max_retries':2,
+            'hedge_after':0.0
         }
     #Customer Assistant Configuration
     if 'bot_config' not in st.session_state:
@@ -59,14 +73,21 @@ def init_session_state():
         }
 
     #Chat Message Information
-    if 'messages' not in st.session_state:
-        st.session_state.messages = []
+    if 'chat_history' not in st.session_state:
+        st.session_state.chat_history = ChatHistory()
+    if 'chat_window' not in st.session_state:
+        st.session_state.chat_window = CHAT_PAGE_SIZE
+    #Conversation context sent to the LLM (summary of older turns + recent turns)
+    if 'conversation_memory' not in st.session_state:
+        st.session_state.conversation_memory = ConversationMemory()
 
     #Knowledge base setting
     if 'knowledge_base' not in st.session_state:
         st.session_state.knowledge_base = {
             'chunks':[],
-            'vector_store':None
+            'vector_store':None,
+            #Incremented every time the document is processed, so that chunk IDs stored in the chat history can be validated
+            'version':0
         }    
 
     #Define orders
@@ -118,9 +139,11 @@ def show_chat():
     """Show chat interface"""
     st.title("AIチャット君")
 
+    history = st.session_state.chat_history
+
     #Displays information about the message
-    if not st.session_state.messages:
-        st.session_state.messages.append({
+    if len(history) == 0:
+        history.append({
             "role":"asssitant",
             #LLM Customer Service Assistant
             "content":st.session_state.bot_config['description']
@@ -129,29 +152,13 @@ def show_chat():
     #Create a dialog box to save the content of the question and answer, including the user's questions and the customer service assistant's answers
     chat_container = st.container()
     with chat_container:
-        for message in st.session_state.messages:
-            if message["role"] == "user":
-                #Set the user-related message style, you can use markdown format
-                st.markdown(f'<div class="message-container"><div class="user-message">{message["content"]}</div></div>', 
-                           unsafe_allow_html=True)
-            else:
-                if message.get("is_knowledge"):
-                    st.markdown(f'<div class="message-container"><div class="knowledge-message">{message["content"]}</div></div>', 
-                               unsafe_allow_html=True)
-                    with st.expander("一致するナレッジブロックを表示"):
-                        #Put the matching documents into docs
-                        for i, doc in enumerate(message["docs"],1 ):
-                            st.write(f"### ナレッジブロック{i}")
-                            st.text(doc["page_content"])
-                else:
-                    #Set the AI assistant-related message style, you can use markdown format
-                    st.markdown(f'<div class="message-container"><div class="bot-message">{message["content"]}</div></div>', 
-                            unsafe_allow_html=True)
-                    if message.get("sources"):
-                        with st.expander("ナレッジベース元"):
-                            #Put the knowledge base source in sources
-                            for source in message["sources"]:
-                                st.write(f"{source}")
+        #Only the visible window is rendered, older messages are loaded on demand
+        if len(history) > st.session_state.chat_window:
+            if st.button("以前のメッセージを表示"):
+                st.session_state.chat_window += CHAT_PAGE_SIZE
+                st.rerun()
+        for message in history.recent(st.session_state.chat_window):
+            render_message(message)
     
     message = st.chat_input("質問を入力してください")
     if message :
@@ -159,53 +166,125 @@ def show_chat():
         process_message(message)
         st.rerun()
 
+def get_resilience_policy() -> ResiliencePolicy:
+    """Build the retry, timeout and hedging settings from the LLM configuration"""
+    config = st.session_state.llm_config
+    return ResiliencePolicy(
+        timeout=config['timeout'],
+        max_retries=config['max_retries'],
+        fallback_url=config['fallback_url'],
+        hedge_after=config['hedge_after']
+    )
+
+def render_message(message: dict):
+    """Render a single chat message"""
+    if message["role"] == "user":
+        #Set the user-related message style, you can use markdown format
+        st.markdown(f'<div class="message-container"><div class="user-message">{message["content"]}</div></div>', 
+                   unsafe_allow_html=True)
+    else:
+        if message.get("is_knowledge"):
+            st.markdown(f'<div class="message-container"><div class="knowledge-message">{message["content"]}</div></div>', 
+                       unsafe_allow_html=True)
+            with st.expander("一致するナレッジブロックを表示"):
+                #Matching documents are stored as chunk IDs of the knowledge base
+                knowledge_base = st.session_state.knowledge_base
+                if message.get("kb_version") != knowledge_base['version']:
+                    st.info("ナレッジベースが更新されたため、このナレッジブロックは表示できません")
+                else:
+                    for i, chunk_id in enumerate(message["doc_ids"],1 ):
+                        st.write(f"### ナレッジブロック{i}")
+                        st.text(knowledge_base['chunks'][chunk_id])
+        else:
+            #Set the AI assistant-related message style, you can use markdown format
+            st.markdown(f'<div class="message-container"><div class="bot-message">{message["content"]}</div></div>', 
+                    unsafe_allow_html=True)
+            if message.get("sources"):
+                with st.expander("ナレッジベース元"):
+                    #Put the knowledge base source in sources
+                    for source in message["sources"]:
+                        st.write(f"{source}")
+
 def process_message(message: str):
     """Processing new messages"""
     if message.strip():
-        intent = classify_intent(
+        try:
+            answer_message(message)
+        except ServiceUnavailableError as e:
+            print(f"LLM API利用不可: {str(e)}")
+            st.session_state.chat_history.append({
+                "role": "assistant",
+                "content": "⚠️ AIサービスが一時的に利用できません。しばらくしてからもう一度お試しください。"
+            })
+
+def answer_message(message: str):
+    """Classify the message, route it and add the reply to the history"""
+    history = st.session_state.conversation_memory.as_messages()
+    intent = classify_intent(
+        url=st.session_state.llm_config['url'],
+        api_key=st.session_state.llm_config['api_key'],
+        model_name=st.session_state.llm_config['model'],
+        message= message,
+        role=st.session_state.bot_config['description'],
+        history=history,
+        policy=get_resilience_policy()
+    )
+
+    st.session_state.chat_history.append({
+        "role":"assistant",
+        "content":message,
+        "sources": intent
+    })
+
+    # Routing to different processing flows based on intent type
+    if intent['intent_type'] == 'order':
+        response = handle_order_query(
             url=st.session_state.llm_config['url'],
             api_key=st.session_state.llm_config['api_key'],
             model_name=st.session_state.llm_config['model'],
-            message= message,
-            role=st.session_state.bot_config['description']
+            message=message,
+            role=st.session_state.bot_config['description'],
+            history=history,
+            policy=get_resilience_policy()
         )
+    elif intent['intent_type'] == 'knowledge':
+        response = handle_knowledge_query(message, history)
+    else:  # Others, it will be handled by human
+        response = handle_human_transfer(intent)
 
-        st.session_state.messages.append({
-            "role":"assistant",
-            "content":message,
-            "sources": intent
-        })
-
-        # Routing to different processing flows based on intent type
-        if intent['intent_type'] == 'order':
-            response = handle_order_query(
-                url=st.session_state.llm_config['url'],
-                api_key=st.session_state.llm_config['api_key'],
-                model_name=st.session_state.llm_config['model'],
-                message=message,
-                role=st.session_state.bot_config['description']
-            )
-        elif intent['intent_type'] == 'knowledge':
-            response = handle_knowledge_query(message)
-        else:  # Others, it will be handled by human
-            response = handle_human_transfer(intent)
-
-        
-        # Add assistant reply
-        st.session_state.messages.append({
-            "role": "assistant",
-            "content": response,
-            "intent": intent  # Save intent information for debugging
-        })
+    
+    # Add assistant reply
+    st.session_state.chat_history.append({
+        "role": "assistant",
+        "content": response,
+        "intent": intent  # Save intent information for debugging
+    })
+
+    # Update the conversation memory, turns that overflow the window are summarized in the background
+    memory = st.session_state.conversation_memory
+    memory.add_exchange(message, response)
+    #The summary runs outside the script run, so the configuration is captured here
+    config = dict(st.session_state.llm_config)
+    policy = get_resilience_policy()
+    memory.summarize_in_background(
+        lambda summary, turns: summarize_conversation(
+            url=config['url'],
+            api_key=config['api_key'],
+            model_name=config['model'],
+            summary=summary,
+            turns=turns,
+            policy=policy
+        )
+    )
 
-def handle_knowledge_query(message: str) -> str:
+def handle_knowledge_query(message: str, history: Optional[List[Dict[str, str]]] = None) -> str:
     """Handling knowledge base related issues"""
     context = ""
     sources = []
     
     # Check if the knowledge base is loaded
     if st.session_state.knowledge_base['vector_store'] is None:
-        st.session_state.messages.append({
+        st.session_state.chat_history.append({
             "role": "assistant",
             "content": "⚠️ ナレッジベースはまだ読み込まれていません。まずはナレッジベース設定ページでドキュメントをアップロードしてください。",
             "is_knowledge": False
@@ -220,15 +299,16 @@ def handle_knowledge_query(message: str) -> str:
     
     # Display knowledge base search results
     if docs:
-        st.session_state.messages.append({
+        st.session_state.chat_history.append({
             "role": "assistant", 
             "content": "🔍 ナレッジベースから以下の情報を見つけてください:",
             "sources": sources,
             "is_knowledge": True,
-            "docs": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+            "doc_ids": [doc.metadata["chunk_id"] for doc in docs],
+            "kb_version": st.session_state.knowledge_base['version']
         })
     else:
-        st.session_state.messages.append({
+        st.session_state.chat_history.append({
             "role": "assistant",
             "content": "ℹ️ ナレッジベースで関連する一致が見つかりません",
             "is_knowledge": False
@@ -240,7 +320,9 @@ def handle_knowledge_query(message: str) -> str:
             message,
             url=st.session_state.llm_config['url'],
             api_key=st.session_state.llm_config['api_key'],
-            model_name=st.session_state.llm_config['model']
+            model_name=st.session_state.llm_config['model'],
+            history=history,
+            policy=get_resilience_policy()
         )
     else:  # If the knowledge base is not hit
         system_prompt = f"{st.session_state.bot_config['description']}"
@@ -251,7 +333,9 @@ def handle_knowledge_query(message: str) -> str:
             api_key=st.session_state.llm_config['api_key'],
             model_name=st.session_state.llm_config['model'],
             prompt=message,
-            system_prompt=system_prompt
+            system_prompt=system_prompt,
+            history=history,
+            policy=get_resilience_policy()
         )
     return bot_response
 
@@ -295,6 +379,60 @@ def show_model_config():
         help = "使用する言語モデルの名前を入力します。例: deepseek-chat"
     )
 
+    #Secondary url setting
+    st.text_input(
+        "予備API URL",
+        value=st.session_state.llm_config['fallback_url'],
+        key="llm_fallback_url",
+        help="応答が遅い場合やエラーが続く場合に使用する予備のAPI URL（空欄の場合は使用しません）"
+    )
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.number_input(
+            "タイムアウト（秒）",
+            min_value=5.0, max_value=300.0,
+            value=float(st.session_state.llm_config['timeout']), step=5.0,
+            key="llm_timeout",
+            help="再試行を含めた1回の呼び出しの制限時間"
+        )
+    with col2:
+        st.number_input(
+            "最大再試行回数",
+            min_value=0, max_value=5,
+            value=int(st.session_state.llm_config['max_retries']), step=1,
+            key="llm_max_retries",
+            help="接続エラーやレート制限などの一時的なエラー時に再試行する回数"
+        )
+    with col3:
+        st.number_input(
+            "ヘッジ待機時間（秒）",
+            min_value=0.0, max_value=60.0,
+            value=float(st.session_state.llm_config['hedge_after']), step=0.5,
+            key="llm_hedge_after",
+            help="この時間内に応答がない場合、予備API URLにも同じリクエストを送信します（0の場合は無効）"
+        )
+
+    #Rate limits are not kept in the session, they are shared by every session using the same API key
+    requests_per_minute, tokens_per_minute = get_rate_limiter(st.session_state.llm_config['api_key']).limits()
+    col1, col2 = st.columns(2)
+    with col1:
+        st.number_input(
+            "リクエスト数上限（回/分）",
+            min_value=0, max_value=10000,
+            value=requests_per_minute, step=10,
+            key="llm_requests_per_minute",
+            help="同じAPIキーを使う全セッション合計の1分あたりのリクエスト数（0の場合は無制限）"
+        )
+    with col2:
+        st.number_input(
+            "トークン数上限（トークン/分）",
+            min_value=0, max_value=10000000,
+            value=tokens_per_minute, step=10000,
+            key="llm_tokens_per_minute",
+            help="同じAPIキーを使う全セッション合計の1分あたりのトークン数（0の場合は無制限）"
+        )
+
     #Save button
     if st.button("保存", type="primary"):
         save_model_config()
@@ -305,8 +443,17 @@ def save_model_config():
     st.session_state.llm_config ={
         'url':st.session_state.llm_url,
         'api_key':st.session_state.llm_key,
-        'model':st.session_state.llm_model
+        'model':st.session_state.llm_model,
+        'fallback_url':st.session_state.llm_fallback_url,
+        'timeout':st.session_state.llm_timeout,
+        'max_retries':st.session_state.llm_max_retries,
+        'hedge_after':st.session_state.llm_hedge_after
     }
+    configure_rate_limiter(
+        st.session_state.llm_key,
+        st.session_state.llm_requests_per_minute,
+        st.session_state.llm_tokens_per_minute
+    )
     st.success("設定が保存されました!")
 
 
@@ -422,6 +569,21 @@ def show_knowledge_config():
     
         separators = [ s.strip() for s in separators_input.split(",") if s.strip()]
 
+    #Embedding configuration
+    st.title("埋め込みモデルの設定")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        embedding_model = st.selectbox("埋め込みモデル", list(EMBEDDING_MODELS),
+                                       index=list(EMBEDDING_MODELS).index(DEFAULT_EMBEDDING_MODEL),
+                                       help="小さいモデルほど高速ですが、検索精度が下がる場合があります")
+    with col2:
+        embedding_backend = st.selectbox("推論バックエンド", EMBEDDING_BACKENDS,
+                                         index=EMBEDDING_BACKENDS.index(DEFAULT_EMBEDDING_BACKEND),
+                                         help="torch-int8: int8量子化（CPU）、onnx: ONNX Runtime（CPU）")
+    with col3:
+        num_threads = st.number_input("スレッド数", min_value=1, max_value=os.cpu_count() or 1,
+                                      value=os.cpu_count() or 1, step=1, help="埋め込みに使用するCPUスレッド数（torchバックエンドではプロセス全体に適用されます）")
+
     #Save uploaded files to session_state
     if upload_file is not None:
         st.session_state.knowledge_base['upload_file'] = upload_file
@@ -435,11 +597,15 @@ def show_knowledge_config():
                 chunk_size=chunk_size,
                 chunk_overlap=chunk_overlap,
                 custom_separators=(use_custom_separators == 'はい'),
-                separators= separators
+                separators= separators,
+                embedding_model=embedding_model,
+                backend=embedding_backend,
+                num_threads=num_threads
             )
             
             st.session_state.knowledge_base['vector_store'] = result[0]
             st.session_state.knowledge_base['chunks'] = result[1]
+            st.session_state.knowledge_base['version'] += 1
 
     #Display file block
     if 'chunks' in st.session_state.knowledge_base:
@@ -453,6 +619,27 @@ def show_knowledge_config():
                 st.text(chunk)
         st.success("ナレッジベースドキュメントの処理が完了しました！")
 
+    #Compare embedding throughput and retrieval recall between backends
+    if st.session_state.knowledge_base['chunks']:
+        st.title("埋め込みバックエンドの比較")
+        all_configs = [f"{model} / {backend}" for model in EMBEDDING_MODELS for backend in EMBEDDING_BACKENDS]
+        selected = st.multiselect(
+            "比較する構成",
+            all_configs,
+            default=[f"{DEFAULT_EMBEDDING_MODEL} / {DEFAULT_EMBEDDING_BACKEND}", f"bge-small-zh-v1.5 / {DEFAULT_EMBEDDING_BACKEND}"],
+            help="先頭の構成の検索結果を基準としてRecallを計算します"
+        )
+        queries_input = st.text_area("検索クエリ（1行に1つ）", help="空欄の場合は先頭のテキストブロックをクエリとして使用します")
+        if st.button("比較を実行") and selected:
+            with st.spinner("比較中....."):
+                results = compare_embedding_backends(
+                    st.session_state.knowledge_base['chunks'],
+                    [tuple(config.split(" / ")) for config in selected],
+                    queries=[q.strip() for q in queries_input.splitlines() if q.strip()],
+                    num_threads=num_threads
+                )
+            st.dataframe(results)
+
     if st.session_state.knowledge_base['vector_store']:
         st.success("ナレッジベースが読み込まれました。")    
 
@@ -0,0 +1,178 @@
+import atexit
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from contextlib import closing
+from typing import Any, Dict, List, Optional
+
+#Default number of messages kept in session memory before older ones are paged out
+MAX_IN_MEMORY_MESSAGES = 50
+
+#Environment variable with the path of the SQLite file used for archived messages
+CHAT_HISTORY_DB_ENV = "CHAT_HISTORY_DB"
+
+#Archived messages of sessions inactive for this many seconds are deleted
+SESSION_TTL_SECONDS = 24 * 60 * 60
+
+#Minimum seconds between updates of the last use time of a session
+TOUCH_INTERVAL_SECONDS = 10 * 60
+
+_default_db_path: Optional[str] = None
+_default_db_lock = threading.Lock()
+
+
+def default_db_path() -> str:
+    """Return the path of the archive
+
+    Uses CHAT_HISTORY_DB if set, otherwise a file in a private temporary
+    directory of this process that is removed when the process exits.
+    """
+    global _default_db_path
+    path = os.environ.get(CHAT_HISTORY_DB_ENV)
+    if path:
+        return path
+    with _default_db_lock:
+        if _default_db_path is None:
+            #mkdtemp creates the directory readable by the current user only
+            directory = tempfile.mkdtemp(prefix="ai_assistant_chat_")
+            atexit.register(shutil.rmtree, directory, ignore_errors=True)
+            _default_db_path = os.path.join(directory, "chat_history.db")
+        return _default_db_path
+
+
+def _delete_session(db_path: str, session_id: str):
+    try:
+        with closing(sqlite3.connect(db_path)) as conn, conn:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+    except sqlite3.Error as e:
+        print(f"チャット履歴削除エラー: {str(e)}")
+
+
+class ChatHistory:
+    """Bounded chat history
+
+    The most recent messages are kept in memory, older messages are paged out
+    to a compact local SQLite store. Retrieved knowledge blocks are stored as
+    chunk IDs (``doc_ids``) that reference the knowledge base chunks, not as a
+    copy of their text.
+    """
+
+    def __init__(self, max_messages: int = MAX_IN_MEMORY_MESSAGES, db_path: Optional[str] = None):
+        """
+        Args:
+            max_messages: Maximum number of messages kept in memory
+            db_path: Path of the SQLite file used for archived messages (see default_db_path)
+        """
+        self.max_messages = max_messages
+        self.db_path = db_path or default_db_path()
+        self.session_id = uuid.uuid4().hex
+        self.messages: List[Dict[str, Any]] = []
+        self.archived_count = 0
+        self._last_touch = 0.0
+        self._init_db()
+        #Delete the archived messages when the Streamlit session (and this object) is discarded
+        self._finalizer = weakref.finalize(self, _delete_session, self.db_path, self.session_id)
+
+    def _connect(self) -> sqlite3.Connection:
+        #Streamlit runs each rerun in its own thread, so open a connection per operation
+        return sqlite3.connect(self.db_path)
+
+    def _init_db(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS messages (
+                    session_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    message TEXT NOT NULL,
+                    PRIMARY KEY (session_id, seq)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    last_seen REAL NOT NULL
+                )"""
+            )
+            #Expire sessions that were not cleaned up, e.g. after a crash
+            expired = time.time() - SESSION_TTL_SECONDS
+            conn.execute(
+                "DELETE FROM messages WHERE session_id IN (SELECT session_id FROM sessions WHERE last_seen < ?)",
+                (expired,)
+            )
+            conn.execute("DELETE FROM sessions WHERE last_seen < ?", (expired,))
+
+    def __len__(self) -> int:
+        return self.archived_count + len(self.messages)
+
+    def append(self, message: Dict[str, Any]):
+        """Add a message and page out the oldest ones if the memory limit is exceeded"""
+        self.messages.append(message)
+        overflow = len(self.messages) - self.max_messages
+        if overflow > 0:
+            self._archive(self.messages[:overflow])
+            del self.messages[:overflow]
+        else:
+            self._touch()
+
+    def _touch(self):
+        """Record that the session is still in use, so that its archive is not expired"""
+        now = time.time()
+        if self.archived_count == 0 or now - self._last_touch < TOUCH_INTERVAL_SECONDS:
+            return
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, last_seen) VALUES (?, ?)",
+                (self.session_id, now)
+            )
+        self._last_touch = now
+
+    def _archive(self, messages: List[Dict[str, Any]]):
+        rows = [
+            (self.session_id, self.archived_count + i, json.dumps(message, ensure_ascii=False, separators=(",", ":")))
+            for i, message in enumerate(messages)
+        ]
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("INSERT INTO messages (session_id, seq, message) VALUES (?, ?, ?)", rows)
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, last_seen) VALUES (?, ?)",
+                (self.session_id, time.time())
+            )
+        self.archived_count += len(rows)
+        self._last_touch = time.time()
+
+    def recent(self, count: int) -> List[Dict[str, Any]]:
+        """Return the latest ``count`` messages in chronological order
+
+        Messages that have been paged out are read back from the local store only
+        when the requested window reaches beyond the in-memory messages.
+        """
+        if count <= len(self.messages):
+            return self.messages[len(self.messages) - count:] if count > 0 else []
+
+        self._touch()
+        archived_needed = min(count - len(self.messages), self.archived_count)
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT message FROM messages WHERE session_id = ? AND seq >= ? ORDER BY seq",
+                (self.session_id, self.archived_count - archived_needed)
+            ).fetchall()
+        if len(rows) < archived_needed:
+            #The archive of this session was expired, only the in-memory messages are left
+            print(f"チャット履歴の一部が期限切れで削除されました: {self.session_id}")
+            _delete_session(self.db_path, self.session_id)
+            self.archived_count = 0
+            return list(self.messages)
+        return [json.loads(row[0]) for row in rows] + self.messages
+
+    def clear(self):
+        """Delete all messages of this session"""
+        _delete_session(self.db_path, self.session_id)
+        self.messages = []
+        self.archived_count = 0
@@ -0,0 +1,124 @@
+import threading
+from typing import Callable, Dict, List, Optional
+
+#Default token budget of the recent turns sent with every LLM call
+DEFAULT_MAX_TOKENS = 1500
+
+#On overflow the window is shrunk to this fraction of the budget, so the summary is updated in batches
+LOW_WATER_RATIO = 0.5
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Roughly estimate the number of tokens of a text
+
+    Non-ASCII characters (Japanese, Chinese) are counted as one token each,
+    ASCII characters as a quarter token.
+    """
+    text = text or ""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def _turns_tokens(turns: List[Dict[str, str]]) -> int:
+    return sum(estimate_tokens(turn["content"]) for turn in turns)
+
+
+class ConversationMemory:
+    """Conversation memory for multi-turn LLM calls
+
+    Keeps a rolling window of recent turns within a token budget. When the
+    window overflows, the oldest turns are moved to a pending list and folded
+    into a running summary in a background thread, so the reply is never held
+    up by the summary. Pending turns are sent as they are until folded in.
+    """
+
+    def __init__(self, max_tokens: int = DEFAULT_MAX_TOKENS, low_water_ratio: float = LOW_WATER_RATIO):
+        """
+        Args:
+            max_tokens: Token budget of the recent turns window
+            low_water_ratio: Fraction of max_tokens the window is shrunk to when it overflows
+        """
+        self.max_tokens = max_tokens
+        self.low_water_tokens = int(max_tokens * low_water_ratio)
+        self.summary = ""
+        self.turns: List[Dict[str, str]] = []
+        #Turns evicted from the window but not yet folded into the summary
+        self.pending: List[Dict[str, str]] = []
+        self._summarizing = False
+        self._lock = threading.Lock()
+
+    def window_tokens(self) -> int:
+        return _turns_tokens(self.turns)
+
+    def add_exchange(self, user_message: str, assistant_message: Optional[str]):
+        """Add a user/assistant exchange to the window
+
+        Args:
+            user_message: User message
+            assistant_message: Assistant reply (None is stored as an empty reply)
+        """
+        with self._lock:
+            self.turns.append({"role": "user", "content": user_message})
+            self.turns.append({"role": "assistant", "content": assistant_message or ""})
+            if self.window_tokens() <= self.max_tokens:
+                return
+
+            #Evict whole exchanges from the front down to the low-water mark, the latest exchange is always kept
+            while len(self.turns) > 2 and self.window_tokens() > self.low_water_tokens:
+                self.pending.extend(self.turns[:2])
+                del self.turns[:2]
+
+            #If summarizing keeps failing, drop the oldest pending turns instead of growing the prompt
+            while len(self.pending) > 2 and _turns_tokens(self.pending) > self.max_tokens:
+                print("会話要約が遅れているため、古い会話を破棄しました")
+                del self.pending[:2]
+
+    def summarize_in_background(self, summarize: Callable[[str, List[Dict[str, str]]], str]):
+        """Fold the pending turns into the summary in a background thread
+
+        Does nothing if there are no pending turns or a summary is already running.
+        Args:
+            summarize: Function that takes the current summary and the pending
+                turns and returns the updated summary. It runs outside the
+                Streamlit script, so it must not use st.session_state.
+        """
+        with self._lock:
+            if self._summarizing or not self.pending:
+                return
+            self._summarizing = True
+            summary, turns = self.summary, list(self.pending)
+
+        def run():
+            new_summary = None
+            try:
+                new_summary = summarize(summary, turns)
+            except Exception as e:
+                #The pending turns are kept, the summary is retried after the next exchange
+                print(f"会話要約エラー: {str(e)}")
+            with self._lock:
+                if new_summary is not None:
+                    self.summary = new_summary
+                    folded = {id(turn) for turn in turns}
+                    self.pending = [turn for turn in self.pending if id(turn) not in folded]
+                self._summarizing = False
+
+        threading.Thread(target=run, name="conversation-summary", daemon=True).start()
+
+    def as_messages(self) -> List[Dict[str, str]]:
+        """Return the summary, pending turns and recent turns as a chat message list"""
+        with self._lock:
+            messages: List[Dict[str, str]] = []
+            if self.summary:
+                messages.append({
+                    "role": "system",
+                    "content": f"これまでの会話の要約:\n{self.summary}"
+                })
+            messages.extend(self.pending)
+            messages.extend(self.turns)
+            return messages
+
+    def clear(self):
+        with self._lock:
+            self.summary = ""
+            self.pending = []
+            self.turns = []
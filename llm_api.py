@@ -1,31 +1,68 @@
-from openai import OpenAI
-from typing import Optional, List, Dict, Any
-from langchain.chains.question_answering import load_qa_chain
-from langchain_deepseek import ChatDeepSeek
+from typing import Optional, List, Dict, Any, Callable
 from pydantic import BaseModel, Field
-from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.prompts import PromptTemplate
 from function import check_order_status
+from resilience import ResiliencePolicy, ServiceUnavailableError, call_with_resilience
+from rate_limiter import PRIORITY_BATCH, PRIORITY_INTERACTIVE, RequestCoalescer, get_rate_limiter, request_key
+from conversation_memory import estimate_tokens
 import json
+import time
+
+#Completion tokens reserved in the rate limiter for each request
+COMPLETION_TOKENS_ESTIMATE = 256
+
+#Maximum number of tool call rounds in an order query
+MAX_TOOL_ROUNDS = 3
+
+#Identical concurrent intent and knowledge requests share one upstream call
+_coalescer = RequestCoalescer()
 
 class IntentClassification(BaseModel):
     """Model of intent recognition classification results"""
     intent_type: str = Field(description="意図タイプ: knowledge|order|other")
     confidence: float = Field(description="意図分類の信頼性 0.0-1.0")
 
+def format_history(history: Optional[List[Dict[str, str]]]) -> str:
+    """Format the conversation history as plain text for prompt templates"""
+    if not history:
+        return "なし"
+    return "\n".join(f"{turn['role']}: {turn['content']}" for turn in history)
+
+def _messages_text(messages: List[Any]) -> str:
+    """Concatenate the contents of a message list, used for token estimation"""
+    return "\n".join(
+        str((message.get("content") if isinstance(message, dict) else message.content) or "")
+        for message in messages
+    )
+
+def _rate_limited(fn: Callable[[str, float], Any], api_key: str, prompt_text: str, priority: int) -> Callable[[str, float], Any]:
+    """Wrap a single request so that it waits for the rate limiter shared by all sessions"""
+    tokens = estimate_tokens(prompt_text) + COMPLETION_TOKENS_ESTIMATE
+
+    def limited(base_url: str, timeout: float) -> Any:
+        start = time.monotonic()
+        get_rate_limiter(api_key).acquire(tokens, priority=priority, timeout=timeout)
+        return fn(base_url, timeout - (time.monotonic() - start))
+
+    return limited
+
 def classify_intent(
         url: str,
         api_key:str,
         model_name:str,
         message: str,
-        role: str
+        role: str,
+        history: Optional[List[Dict[str, str]]] = None,
+        policy: Optional[ResiliencePolicy] = None,
+        priority: int = PRIORITY_INTERACTIVE
 )-> dict:
     
+    from langchain_core.output_parsers import JsonOutputParser
+    from langchain_core.prompts import PromptTemplate
+    from langchain_deepseek import ChatDeepSeek
+
     #Setting the output parser
     #When the LLM parses the user's request (message), it generates Json output
     parser = JsonOutputParser(pydantic_object=IntentClassification)
-    #Create LLM
-    llm = ChatDeepSeek(model=model_name, api_key=api_key, base_url=url)
     #Prompt template
     prompt = PromptTemplate(
             template="""{role}として以下のユーザーからの質問の意図を分類してください：
@@ -34,15 +71,27 @@ def classify_intent(
             2. 注文に関する質問（order）：注文状況や配送情報などに関する質問
             3. その他の質問（other）：手動によるカスタマーサービスが必要な複雑な質問 \n
             {format_instructions} \n
+            これまでの会話: \n{history} \n
             ユーザーからの質問: {message} \n
             """,
-            input_variables=["role", "message"],
+            input_variables=["role", "message", "history"],
             partial_variables={"format_instructions": parser.get_format_instructions()}
         )
-    #Create a chain call Prompt → LLM → Paser Output
-    chain = prompt | llm | parser
-    #Execute call
-    result = chain.invoke({"role":role, "message":message})
+    inputs = {"role":role, "message":message, "history":format_history(history)}
+
+    def invoke(base_url: str, timeout: float) -> dict:
+        #Create LLM, retries are handled by call_with_resilience
+        llm = ChatDeepSeek(model=model_name, api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0)
+        #Create a chain call Prompt → LLM → Paser Output
+        chain = prompt | llm | parser
+        #Execute call
+        return chain.invoke(inputs)
+
+    key = request_key("classify_intent", url, api_key, model_name, inputs)
+    result = _coalescer.run(
+        key,
+        lambda: call_with_resilience(_rate_limited(invoke, api_key, prompt.format(**inputs), priority), url, policy)
+    )
 
     return {
         "intent_type": result["intent_type"],
@@ -55,7 +104,10 @@ def handle_order_query(
     api_key: str,
     model_name: str,
     message: str,
-    role: str
+    role: str,
+    history: Optional[List[Dict[str, str]]] = None,
+    policy: Optional[ResiliencePolicy] = None,
+    priority: int = PRIORITY_INTERACTIVE
     #check_order_status: callable
 ) -> str:
     """Processes order queries
@@ -66,6 +118,9 @@ def handle_order_query(
         model_name: Model name
         message: User message
         role: Customer service role description
+        history: Previous conversation messages (summary and recent turns)
+        policy: Retry, timeout and hedging settings
+        priority: Rate limiter queue priority
         check_order_status: Function that checks order status
         
     Returns:
@@ -78,6 +133,7 @@ def handle_order_query(
                 "role": "system",
                 "content": role
             },
+            *(history or []),
             {
                 "role": "user",
                 "content": message
@@ -105,20 +161,25 @@ def handle_order_query(
             }
         ]
         
-        # The first call gets the possible tool calls
-        response = call_llm_tools(
-            url=url,
-            api_key=api_key,
-            model_name=model_name,
-            messages=messages,
-            tools=tools
-        )
-        
-        response_message = response.choices[0].message
-        tool_calls = response_message.tool_calls
-        
-        # Check if there is a tool call
-        if tool_calls:
+        # Call the model until it stops requesting tools, the model may chain several tool calls
+        for _ in range(MAX_TOOL_ROUNDS):
+            response = call_llm_tools(
+                url=url,
+                api_key=api_key,
+                model_name=model_name,
+                messages=messages,
+                tools=tools,
+                policy=policy,
+                priority=priority
+            )
+            
+            response_message = response.choices[0].message
+            tool_calls = response_message.tool_calls
+            
+            # If there is no tool call, return the response directly
+            if not tool_calls:
+                return response_message.content or ""
+            
             messages.append(response_message)
             
             # Process each tool call
@@ -139,24 +200,36 @@ def handle_order_query(
                             "content": json.dumps(order_info)
                         }
                     )
-            
-            # The second call gets the final response
-            second_response = call_llm_tools(
-                url=url,
-                api_key=api_key,
-                model_name=model_name,
-                messages=messages,
-                tools=tools
-            )
-            
-            return second_response.choices[0].message.content
+                else:
+                    #Every tool call needs a tool message, otherwise the next request is rejected
+                    messages.append(
+                        {
+                            "tool_call_id": tool_call.id,
+                            "role": "tool",
+                            "name": tool_call.function.name,
+                            "content": json.dumps({"error": f"未対応のツールです: {tool_call.function.name}"}, ensure_ascii=False)
+                        }
+                    )
         
-        # If there is no tool call, return the response directly
-        return response_message.content
+        # Too many tool rounds, ask for the final response without tools
+        final_response = call_llm_tools(
+            url=url,
+            api_key=api_key,
+            model_name=model_name,
+            messages=messages,
+            tools=tools,
+            tool_choice="none",
+            policy=policy,
+            priority=priority
+        )
+        return final_response.choices[0].message.content or ""
     
-    except Exception as e:
+    except ServiceUnavailableError as e:
         print(f"注文クエリエラー: {str(e)}")
         return "注文追跡サービスは一時的に利用できません。しばらくしてからもう一度お試しください。"
+    except json.JSONDecodeError as e:
+        print(f"注文クエリエラー: {str(e)}")
+        return "注文番号を読み取れませんでした。お手数ですが、注文番号をもう一度入力してください。"
 
 def call_llm_docs(
         docs:List[Any],
@@ -164,12 +237,30 @@ def call_llm_docs(
         url:str,
         api_key:str,
         model_name:str,
+        history: Optional[List[Dict[str, str]]] = None,
+        policy: Optional[ResiliencePolicy] = None,
+        priority: int = PRIORITY_INTERACTIVE
 )->str:
-    #Deepseek client
-    llm = ChatDeepSeek(model=model_name, api_key = api_key, base_url = url)
-    chain = load_qa_chain(llm=llm, chain_type="stuff")
-    #Submit the matched documents and user questions to DeepSeek for polishing
-    response = chain.run(input_documents = docs, question = query)
+    from langchain.chains.question_answering import load_qa_chain
+    from langchain_deepseek import ChatDeepSeek
+
+    #The stuff chain only takes a question, so the conversation is prepended to it
+    if history:
+        query = f"これまでの会話:\n{format_history(history)}\n\nユーザーからの質問: {query}"
+
+    def run(base_url: str, timeout: float) -> str:
+        #Deepseek client
+        llm = ChatDeepSeek(model=model_name, api_key = api_key, base_url = base_url, timeout=timeout, max_retries=0)
+        chain = load_qa_chain(llm=llm, chain_type="stuff")
+        #Submit the matched documents and user questions to DeepSeek for polishing
+        return chain.run(input_documents = docs, question = query)
+
+    contents = [doc.page_content for doc in docs]
+    key = request_key("call_llm_docs", url, api_key, model_name, contents, query)
+    response = _coalescer.run(
+        key,
+        lambda: call_with_resilience(_rate_limited(run, api_key, "\n".join(contents + [query]), priority), url, policy)
+    )
     return response
 
 def call_llm(
@@ -178,11 +269,13 @@ def call_llm(
         model_name:str,
         prompt: str,
         system_prompt: Optional[str] =None,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        history: Optional[List[Dict[str, str]]] = None,
+        policy: Optional[ResiliencePolicy] = None,
+        priority: int = PRIORITY_INTERACTIVE
 ) -> str:
     """Call the LLM API to get a response"""
-
-    client = OpenAI(api_key=api_key, base_url=url)
+    from openai import OpenAI
 
     # Building a message list
     messages: List[Dict[str, str]] = []
@@ -191,28 +284,61 @@ def call_llm(
             "role":"assistant",
             "content":system_prompt
         })
+
+    if history:
+        messages.extend(history)
     
     messages.append({
         "role": "user",
         "content": prompt
     })
     
-    response = client.chat.completions.create(
-        model=model_name,
-        messages=messages,
-        temperature= temperature,
-        stream=False
-    )
+    def create(base_url: str, timeout: float) -> Any:
+        client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0)
+        return client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature= temperature,
+            stream=False
+        )
 
+    response = call_with_resilience(_rate_limited(create, api_key, _messages_text(messages), priority), url, policy)
     return response.choices[0].message.content
 
+def summarize_conversation(
+        url:str,
+        api_key:str,
+        model_name:str,
+        summary: str,
+        turns: List[Dict[str, str]],
+        policy: Optional[ResiliencePolicy] = None
+) -> str:
+    """Fold evicted conversation turns into the running summary"""
+    prompt = f"""以下の「これまでの要約」に「新しい会話」の内容を統合し、簡潔な要約を作成してください。
+    注文番号や製品名などの重要な情報は必ず残してください。要約のみを出力してください。\n
+    これまでの要約: \n{summary or "なし"} \n
+    新しい会話: \n{format_history(turns)} \n
+    """
+    return call_llm(
+        url=url,
+        api_key=api_key,
+        model_name=model_name,
+        prompt=prompt,
+        temperature=0.3,
+        policy=policy,
+        #Summaries are background work and yield to interactive chat
+        priority=PRIORITY_BATCH
+    )
+
 def call_llm_tools(
     url: str,
     api_key: str,
     model_name: str,
     messages: List[Dict[str, str]],
     tools: List[Dict[str, Any]],
-    tool_choice: str = "auto"
+    tool_choice: str = "auto",
+    policy: Optional[ResiliencePolicy] = None,
+    priority: int = PRIORITY_INTERACTIVE
 ) -> Any:
     """
     LLM API that supports tool calls
@@ -224,19 +350,25 @@ def call_llm_tools(
         messages: Message list
         tools: Tool definition list
         tool_choice: Tool selection mode
+        policy: Retry, timeout and hedging settings
+        priority: Rate limiter queue priority
         
     Returns:
         Any: Model response object
     """
-    try:
-        client = OpenAI(api_key=api_key, base_url=url)
-        
-        response = client.chat.completions.create(
+    from openai import OpenAI
+
+    def create(base_url: str, timeout: float) -> Any:
+        client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0)
+        return client.chat.completions.create(
             model=model_name,
             messages=messages,
             tools=tools,
             tool_choice=tool_choice
         )
+
+    try:
+        response = call_with_resilience(_rate_limited(create, api_key, _messages_text(messages), priority), url, policy)
         
         #Tell the application which function to call
         return response
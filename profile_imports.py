@@ -0,0 +1,64 @@
+"""Import-time profile of the application
+
+Usage:
+    python profile_imports.py [--top N]
+
+Imports ``app`` (including streamlit and every module app.py imports) in a
+fresh interpreter with ``-X importtime``, prints the slowest imports and checks
+that the heavy ML dependencies are not loaded before the knowledge or LLM path
+is used. ``main()`` is not run, so the report covers the import cost of each
+script run, not the Streamlit server startup or the rendering of the page.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+#Dependencies that must only be imported lazily
+HEAVY_MODULES = ["torch", "transformers", "sentence_transformers", "onnxruntime", "faiss",
+                 "langchain", "langchain_community", "langchain_core", "langchain_deepseek", "openai"]
+
+
+def profile(top: int) -> int:
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import app\n"
+        "print(f'TOTAL {time.perf_counter() - start:.3f}')\n"
+        f"print('LOADED ' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n"
+    )
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        print(result.stderr)
+        return result.returncode
+
+    #Each line: "import time: self [us] | cumulative | imported package"
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        rows.append((int(cumulative_us), int(self_us), name))
+
+    lines = result.stdout.splitlines()
+    total = next(line.split()[1] for line in lines if line.startswith("TOTAL"))
+    loaded = next(line[len("LOADED "):] for line in lines if line.startswith("LOADED"))
+
+    print(f"app.py import time (including streamlit): {total}s")
+    print(f"\nTop {top} imports by cumulative time:")
+    print(f"{'cumulative(ms)':>15} {'self(ms)':>10}  module")
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:>15.1f} {self_us / 1000:>10.1f}  {name}")
+
+    if loaded:
+        print(f"\nNG: heavy modules loaded at startup: {loaded}")
+        return 1
+    print("\nOK: no heavy modules loaded at startup")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile the import time of the app modules")
+    parser.add_argument("--top", type=int, default=20, help="Number of imports to show")
+    sys.exit(profile(parser.parse_args().top))
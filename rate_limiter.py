@@ -0,0 +1,183 @@
+import hashlib
+import heapq
+import itertools
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
+from resilience import ServiceUnavailableError
+
+T = TypeVar("T")
+
+#Lower value is served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+#Limits of an API key until they are changed on the model config page
+DEFAULT_REQUESTS_PER_MINUTE = 60
+DEFAULT_TOKENS_PER_MINUTE = 100000
+
+
+class RateLimitTimeout(ServiceUnavailableError):
+    """Raised when the rate limiter could not grant a request before its deadline"""
+
+
+class _TokenBucket:
+    """Token bucket refilled continuously at ``per_minute`` tokens per minute (0 means unlimited)"""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def set_rate(self, per_minute: int):
+        now = time.monotonic()
+        if self.per_minute <= 0:
+            #The bucket was unlimited, start full
+            self.level = float(per_minute)
+        else:
+            self._refill(now)
+            self.level = min(self.level, float(per_minute))
+        self.per_minute = per_minute
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.level = min(float(self.per_minute), self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def wait_time(self, amount: int, now: float) -> float:
+        """Seconds until ``amount`` tokens are available"""
+        if self.per_minute <= 0:
+            return 0.0
+        self._refill(now)
+        #A request larger than the bucket is allowed once the bucket is full
+        amount = min(amount, self.per_minute)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60 / self.per_minute
+
+    def consume(self, amount: int):
+        if self.per_minute > 0:
+            self.level -= min(amount, self.per_minute)
+
+
+class RateLimiter:
+    """Token-bucket rate limiter with a priority queue
+
+    Limits both requests per minute and tokens per minute. Waiting callers are
+    served in priority order, so interactive chat is not stuck behind batch work.
+    """
+
+    def __init__(self, requests_per_minute: int = 0, tokens_per_minute: int = 0):
+        """
+        Args:
+            requests_per_minute: Maximum requests per minute (0 means unlimited)
+            tokens_per_minute: Maximum tokens per minute (0 means unlimited)
+        """
+        self._requests = _TokenBucket(requests_per_minute)
+        self._tokens = _TokenBucket(tokens_per_minute)
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def limits(self) -> Tuple[int, int]:
+        """Return (requests per minute, tokens per minute)"""
+        with self._cond:
+            return self._requests.per_minute, self._tokens.per_minute
+
+    def set_limits(self, requests_per_minute: int, tokens_per_minute: int):
+        with self._cond:
+            self._requests.set_rate(requests_per_minute)
+            self._tokens.set_rate(tokens_per_minute)
+            self._cond.notify_all()
+
+    def acquire(self, tokens: int, priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None):
+        """Block until one request and ``tokens`` tokens are available
+
+        Args:
+            tokens: Estimated tokens of the request
+            priority: Queue priority, PRIORITY_INTERACTIVE or PRIORITY_BATCH
+            timeout: Maximum seconds to wait
+        Raises:
+            RateLimitTimeout: If the request could not be granted within timeout
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            entry: Tuple[int, int] = (priority, next(self._seq))
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait: Optional[float] = None
+                    #Only the head of the queue may take tokens
+                    if self._waiters[0] == entry:
+                        wait = max(self._requests.wait_time(1, now), self._tokens.wait_time(tokens, now))
+                        if wait == 0:
+                            self._requests.consume(1)
+                            self._tokens.consume(tokens)
+                            return
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            raise RateLimitTimeout("APIのレート制限により、リクエストを送信できませんでした")
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(api_key: str) -> RateLimiter:
+    """Return the process-wide rate limiter of an API key"""
+    with _limiters_lock:
+        if api_key not in _limiters:
+            _limiters[api_key] = RateLimiter(DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE)
+        return _limiters[api_key]
+
+
+def configure_rate_limiter(api_key: str, requests_per_minute: int, tokens_per_minute: int):
+    """Set the limits of the rate limiter shared by all sessions using the API key"""
+    get_rate_limiter(api_key).set_limits(requests_per_minute, tokens_per_minute)
+
+
+class RequestCoalescer:
+    """Share one upstream call between identical concurrent requests"""
+
+    def __init__(self):
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: str, fn: Callable[[], T]) -> T:
+        """Run fn, or wait for the result of the in-flight call with the same key"""
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._inflight[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+
+def request_key(*parts: Any) -> str:
+    """Build a coalescing key from JSON-serializable request parameters"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
@@ -0,0 +1,212 @@
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+def is_retriable(error: BaseException) -> bool:
+    """Whether an error is worth retrying: network failures, timeouts, rate limits and 5xx responses"""
+    import openai
+
+    return isinstance(error, (
+        openai.APIConnectionError,
+        openai.RateLimitError,
+        openai.InternalServerError,
+        TimeoutError,
+    ))
+
+#Shared by all sessions, only used to run hedged requests
+#A losing request that is already running keeps its worker until its client timeout
+HEDGE_MAX_WORKERS = 16
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="llm-hedge")
+
+
+@dataclass
+class ResiliencePolicy:
+    """Retry, timeout and hedging settings of an LLM call
+
+    Attributes:
+        timeout: Deadline of the whole call in seconds, including retries (applied through the client timeout)
+        max_retries: Number of retries after the first attempt
+        backoff_base: Base delay of the exponential backoff in seconds
+        backoff_max: Maximum backoff delay in seconds
+        fallback_url: Secondary API base URL used for hedging and when the primary circuit is open
+        hedge_after: Seconds to wait before sending a hedged request to fallback_url (0 disables hedging)
+    """
+    timeout: float = 60.0
+    max_retries: int = 2
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    fallback_url: str = ""
+    hedge_after: float = 0.0
+
+
+class ServiceUnavailableError(Exception):
+    """Raised when the LLM API is down, too slow or rate limited"""
+
+
+class CircuitOpenError(ServiceUnavailableError):
+    """Raised when every endpoint of a call has an open circuit"""
+
+
+class CircuitBreaker:
+    """Circuit breaker of a single API endpoint
+
+    After ``failure_threshold`` consecutive failures the circuit opens and calls
+    are rejected for ``reset_timeout`` seconds. Then a single trial call is let
+    through (half-open), which closes the circuit again on success.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def release(self):
+        """Give back a trial slot that was not used for an actual request"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(url: str) -> CircuitBreaker:
+    """Return the process-wide circuit breaker of an endpoint"""
+    with _breakers_lock:
+        if url not in _breakers:
+            _breakers[url] = CircuitBreaker()
+        return _breakers[url]
+
+
+def _attempt(fn: Callable[[str, float], T], url: str, timeout: float) -> T:
+    import openai
+
+    breaker = get_circuit_breaker(url)
+    try:
+        result = fn(url, timeout)
+    except Exception as e:
+        if is_retriable(e):
+            breaker.record_failure()
+        elif isinstance(e, openai.APIStatusError):
+            #The endpoint responded, only the request itself was rejected
+            breaker.record_success()
+        else:
+            breaker.release()
+        raise
+    breaker.record_success()
+    return result
+
+
+def _hedged_attempt(fn: Callable[[str, float], T], primary: str, secondary: str, hedge_after: float, deadline: float) -> T:
+    """Send the request to primary, and also to secondary if primary is slower than hedge_after"""
+    started = threading.Event()
+
+    def run(url: str) -> T:
+        if url == primary:
+            started.set()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("LLM呼び出しがタイムアウトしました")
+        return _attempt(fn, url, remaining)
+
+    urls = [primary]
+    futures = [_hedge_executor.submit(run, primary)]
+    try:
+        #The hedge delay is measured from when the primary request starts, not from when it is queued
+        if not started.wait(max(deadline - time.monotonic(), 0)):
+            raise TimeoutError("LLM呼び出しがタイムアウトしました")
+        done, _ = wait(futures, timeout=min(hedge_after, max(deadline - time.monotonic(), 0)))
+        if not done and get_circuit_breaker(secondary).allow():
+            urls.append(secondary)
+            futures.append(_hedge_executor.submit(run, secondary))
+
+        #Return the first successful response
+        error: Optional[BaseException] = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError("LLM呼び出しがタイムアウトしました")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+    finally:
+        #Drop requests that have not started yet, a running loser finishes within its client timeout
+        for url, future in zip(urls, futures):
+            if future.cancel():
+                get_circuit_breaker(url).release()
+
+
+def call_with_resilience(fn: Callable[[str, float], T], url: str, policy: Optional[ResiliencePolicy] = None) -> T:
+    """Call an LLM endpoint with deadline, retries, circuit breaker and hedging
+
+    The deadline is enforced by passing the remaining time to fn as its
+    timeout, so fn must apply it to its HTTP client (e.g. ``OpenAI(timeout=...)``).
+    Only hedged requests are additionally abandoned when the deadline passes.
+    Args:
+        fn: Function performing a single request, called with (base_url, timeout)
+        url: Primary API base URL
+        policy: Resilience settings, the defaults are used if omitted
+    Returns:
+        The result of fn
+    Raises:
+        ServiceUnavailableError: If the endpoints are down, slow or rate limited after all retries
+    """
+    policy = policy or ResiliencePolicy()
+    deadline = time.monotonic() + policy.timeout
+
+    attempt = 0
+    while True:
+        #Use the fallback URL when the circuit of the primary URL is open
+        primary = next((u for u in (url, policy.fallback_url) if u and get_circuit_breaker(u).allow()), None)
+        if primary is None:
+            raise CircuitOpenError(f"エンドポイントが一時的に利用できません: {url}")
+
+        remaining = deadline - time.monotonic()
+        try:
+            if primary == url and policy.fallback_url and 0 < policy.hedge_after < remaining:
+                return _hedged_attempt(fn, primary, policy.fallback_url, policy.hedge_after, deadline)
+            return _attempt(fn, primary, remaining)
+        except Exception as e:
+            if not is_retriable(e):
+                raise
+            #Exponential backoff with full jitter
+            delay = random.uniform(0, min(policy.backoff_max, policy.backoff_base * (2 ** attempt)))
+            if attempt >= policy.max_retries or time.monotonic() + delay >= deadline:
+                raise ServiceUnavailableError(f"LLM APIを利用できません: {str(e)}") from e
+            print(f"LLM呼び出しを再試行します ({attempt + 1}/{policy.max_retries}): {str(e)}")
+            time.sleep(delay)
+            attempt += 1
@@ -1,22 +1,136 @@
-from langchain_community.vectorstores import FAISS
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from typing import Tuple, List
-import torch
-from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+from typing import Tuple, List, Dict, Optional, TYPE_CHECKING
+import gc
+import os
+import time
+import threading
+from concurrent.futures import Future
 
+#torch, langchain and numpy are imported inside the functions that need them,
+#so that importing this module (and starting the app) stays fast
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.embeddings import HuggingFaceBgeEmbeddings
 
-def process_document_deepseek(file, chunk_size: int=100, chunk_overlap: int=20, custom_separators:bool = False, separators: list=None)-> Tuple[FAISS, List[str]]:
-    """Process uploaded documents (deepseek-only)
+#Selectable embedding models (display name -> Hugging Face model name)
+EMBEDDING_MODELS = {
+    "bge-large-zh-v1.5": "BAAI/bge-large-zh-v1.5",
+    "bge-base-zh-v1.5": "BAAI/bge-base-zh-v1.5",
+    "bge-small-zh-v1.5": "BAAI/bge-small-zh-v1.5",
+}
+DEFAULT_EMBEDDING_MODEL = "bge-large-zh-v1.5"
+
+#Selectable inference backends
+#torch: PyTorch (GPU if available), torch-int8: PyTorch with int8 dynamic quantization on CPU, onnx: ONNX Runtime on CPU
+EMBEDDING_BACKENDS = ["torch", "torch-int8", "onnx"]
+DEFAULT_EMBEDDING_BACKEND = "torch"
+
+#Loaded embedding models are reused across Streamlit reruns and sessions
+#Key: (model, backend, threads), threads is only part of the key for onnx
+#A model being loaded is stored as an unfinished Future, so other callers wait for that load only
+_embeddings_cache: Dict[Tuple[str, str, int], Future] = {}
+#Only guards the dict, models are loaded outside of it
+_embeddings_lock = threading.Lock()
+
+
+def get_embeddings(
+        model: str = DEFAULT_EMBEDDING_MODEL,
+        backend: str = DEFAULT_EMBEDDING_BACKEND,
+        num_threads: Optional[int] = None,
+        cache: bool = True
+) -> "HuggingFaceBgeEmbeddings":
+    """Load (or reuse) an embedding model
     Args:
-        file: Uploaded file
-        chunk_size: Chunk size
-        chunk_overlap: Chunk overlap
-        custom_separators: Whether to use custom separators
-        separators: Custom separators
+        model: Key of EMBEDDING_MODELS
+        backend: One of EMBEDDING_BACKENDS
+        num_threads: Number of CPU threads used for inference (defaults to the number of CPUs).
+            For the torch backends this is the process-wide PyTorch setting, applied on every call,
+            so the latest call decides it for all torch models.
+        cache: Keep a newly loaded model for later calls
     Returns:
-        FAISS: Vector database
-        List: Text chunks after segmentation
+        HuggingFaceBgeEmbeddings: Embedding model
     """
+    if model not in EMBEDDING_MODELS:
+        raise ValueError(f"未対応の埋め込みモデルです: {model}")
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"未対応の埋め込みバックエンドです: {backend}")
+    num_threads = num_threads or os.cpu_count() or 1
+
+    if backend != "onnx":
+        import torch
+        torch.set_num_threads(num_threads)
+
+    #ONNX Runtime sessions have their own thread count, torch weights are shared by every thread count
+    key = (model, backend, num_threads if backend == "onnx" else 0)
+    with _embeddings_lock:
+        future = _embeddings_cache.get(key)
+        loading = future is None
+        if loading:
+            future = Future()
+            if cache:
+                _embeddings_cache[key] = future
+    if not loading:
+        return future.result()
+
+    try:
+        embeddings = _load_embeddings(EMBEDDING_MODELS[model], backend, num_threads)
+    except BaseException as e:
+        #Let a later call retry the load
+        with _embeddings_lock:
+            if _embeddings_cache.get(key) is future:
+                del _embeddings_cache[key]
+        future.set_exception(e)
+        raise
+    future.set_result(embeddings)
+    return embeddings
+
+
+def _load_embeddings(model_name: str, backend: str, num_threads: int) -> "HuggingFaceBgeEmbeddings":
+    from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+
+    encode_kwargs = {"normalize_embeddings": True}
+
+    if backend == "onnx":
+        try:
+            import onnxruntime
+            import optimum.onnxruntime  # noqa: F401  (required by the sentence-transformers onnx backend)
+        except ImportError as e:
+            raise ImportError("ONNX Runtimeバックエンドを使用するには、optimum[onnxruntime] をインストールしてください") from e
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        #sentence-transformers exports the model to ONNX on first load
+        return HuggingFaceBgeEmbeddings(
+            model_name=model_name,
+            model_kwargs={
+                "device": "cpu",
+                "backend": "onnx",
+                "model_kwargs": {"provider": "CPUExecutionProvider", "session_options": session_options}
+            },
+            encode_kwargs=encode_kwargs
+        )
+
+    import torch
+
+    if backend == "torch-int8":
+        embeddings = HuggingFaceBgeEmbeddings(
+            model_name=model_name,
+            model_kwargs={"device": "cpu"},
+            encode_kwargs=encode_kwargs
+        )
+        #Quantize the weights of the linear layers to int8, activations are quantized at runtime
+        torch.quantization.quantize_dynamic(embeddings.client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return embeddings
+
+    return HuggingFaceBgeEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"},
+        encode_kwargs=encode_kwargs
+    )
+
+
+def split_document(file, chunk_size: int=100, chunk_overlap: int=20, custom_separators:bool = False, separators: list=None) -> List[str]:
+    """Split an uploaded document into text chunks"""
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
     #Read file
     text = file.read().decode("utf-8")
 
@@ -31,22 +145,111 @@ def process_document_deepseek(file, chunk_size: int=100, chunk_overlap: int=20,
         text_splitter = RecursiveCharacterTextSplitter(
             chunk_size = chunk_size,
             chunk_overlap = chunk_overlap,)
-    
+
     #Document chunks
-    chunks = text_splitter.split_text(text)
+    return text_splitter.split_text(text)
+
+
+def process_document_deepseek(
+        file,
+        chunk_size: int=100,
+        chunk_overlap: int=20,
+        custom_separators:bool = False,
+        separators: list=None,
+        embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+        backend: str = DEFAULT_EMBEDDING_BACKEND,
+        num_threads: Optional[int] = None
+)-> Tuple["FAISS", List[str]]:
+    """Process uploaded documents (deepseek-only)
+    Args:
+        file: Uploaded file
+        chunk_size: Chunk size
+        chunk_overlap: Chunk overlap
+        custom_separators: Whether to use custom separators
+        separators: Custom separators
+        embedding_model: Embedding model (key of EMBEDDING_MODELS)
+        backend: Embedding inference backend (one of EMBEDDING_BACKENDS)
+        num_threads: Number of CPU threads used for embedding (process-wide for the torch backends)
+    Returns:
+        FAISS: Vector database
+        List: Text chunks after segmentation
+    """
+    from langchain_community.vectorstores import FAISS
+
+    chunks = split_document(file, chunk_size, chunk_overlap, custom_separators, separators)
 
     #Embed the segmented documents into the vector database
     #The ability of LLM affects search capabilities
-    model_name = "BAAI/bge-large-zh-v1.5"
-    model_kwargs = {"device": "cuda" if torch.cuda.is_available() else "cpu"}
-    encode_kwargs = {"normalize_embeddings": True}
+    embeddings = get_embeddings(embedding_model, backend, num_threads)
 
-    embeddings = HuggingFaceBgeEmbeddings(
-        model_name=model_name,
-        model_kwargs = model_kwargs,
-        encode_kwargs = encode_kwargs
+    #Embed the cut file blocks into the vector database
+    #The chunk ID lets the chat history reference a block instead of copying its text
+    vector_store = FAISS.from_texts(
+        chunks,
+        embedding=embeddings,
+        metadatas=[{"chunk_id": i} for i in range(len(chunks))]
     )
+    return vector_store, chunks
 
-    #Embed the cut file blocks into the vector database
-    vector_store = FAISS.from_texts(chunks, embedding=embeddings)
-    return vector_store, chunks
\ No newline at end of file
+
+def compare_embedding_backends(
+        chunks: List[str],
+        configs: List[Tuple[str, str]],
+        queries: Optional[List[str]] = None,
+        k: int = 4,
+        num_threads: Optional[int] = None
+) -> List[Dict]:
+    """Compare embedding throughput and retrieval recall between models and backends
+
+    Recall@k is measured against the top-k chunks retrieved with the first
+    configuration, which should be the most accurate one (e.g. bge-large on torch).
+    Models that are not already cached are loaded only for the comparison and
+    freed afterwards.
+    Args:
+        chunks: Text chunks to embed
+        configs: (model, backend) pairs, the first one is the reference
+        queries: Search queries, up to 10 chunks are used as queries if omitted
+        k: Number of retrieved chunks
+        num_threads: Number of CPU threads used for embedding
+    Returns:
+        List: One result row per configuration
+    """
+    import numpy as np
+
+    queries = queries or chunks[:10]
+    k = min(k, len(chunks))
+
+    results = []
+    reference = None
+    for model, backend in configs:
+        start = time.perf_counter()
+        embeddings = get_embeddings(model, backend, num_threads, cache=False)
+        load_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        doc_vectors = np.array(embeddings.embed_documents(chunks))
+        doc_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        query_vectors = np.array([embeddings.embed_query(query) for query in queries])
+        query_seconds = time.perf_counter() - start
+
+        #Vectors are normalized, so the inner product is the cosine similarity
+        top_k = np.argsort(-(query_vectors @ doc_vectors.T), axis=1)[:, :k]
+        if reference is None:
+            reference = top_k
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(top_k, reference)])
+
+        results.append({
+            "モデル": model,
+            "バックエンド": backend,
+            "読み込み時間(秒)": round(load_seconds, 2),
+            "文書埋め込み(ブロック/秒)": round(len(chunks) / doc_seconds, 1),
+            "クエリ埋め込み(ミリ秒)": round(query_seconds * 1000 / len(queries), 1),
+            f"Recall@{k}": round(float(recall), 3),
+        })
+
+        #Free models that were loaded only for the comparison
+        del embeddings, doc_vectors, query_vectors
+        gc.collect()
+    return results